@@ -1,23 +1,89 @@
 #!/usr/bin/env python3
-import glob
+import atexit
+import contextlib
+import errno
+import fnmatch
+import functools
+import hashlib
+import operator
 import os
-import shutil
+import random
+import re
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from subprocess import CalledProcessError
+from typing import TypeVar
+
+from qcloud_cos import CosConfig, CosS3Client
+from qcloud_cos.cos_exception import CosClientError, CosServiceError
+
+try:
+    import fcntl
+except ImportError:  # non-POSIX
+    fcntl = None
+
+T = TypeVar("T")
+
+FICLONE = 0x40049409
+COPY_BUFSIZE = 1024 * 1024
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
+_REFLINK_UNSUPPORTED = frozenset({errno.EOPNOTSUPP, errno.ENOTSUP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EBADF})
+_LINK_UNSUPPORTED = frozenset({errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP})
+_SENDFILE_UNSUPPORTED = frozenset({errno.EINVAL, errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP})
+ACCELERATE_ENDPOINT = "cos.accelerate.myqcloud.com"
+UPLOAD_WORKERS = 8
+PART_SIZE_MB = 8
+ACCELERATE_PART_THREADS = 5
+DELETE_BATCH = 1000
+PURGE_BATCH = 30
+_TRUE_VALUES = frozenset({"true", "1", "yes", "y"})
+_FALSE_VALUES = frozenset({"false", "0", "no", "n", ""})
+_COMMA_TO_NEWLINE = {ord(","): "\n"}
+_MAGIC_CHECK = re.compile(r"[*?[]")
+LOG_FLUSH_EVERY = 256
+VERBOSE = os.environ.get("SIFLI_VERBOSE", "").strip().lower() in _TRUE_VALUES
+
+_LOG_BUF: list[str] = []
+_LOG_LOCK = threading.Lock()  # log() is called from upload worker threads
+
+
+def flush_logs() -> None:
+    global _LOG_BUF
+    with _LOG_LOCK:
+        lines, _LOG_BUF = _LOG_BUF, []
+    if lines:
+        sys.stdout.write("\n".join(lines) + "\n")
+    sys.stdout.flush()
 
 
 def log(msg: str) -> None:
-    print(f"[cos-sync] {msg}")
+    with _LOG_LOCK:
+        _LOG_BUF.append(f"[cos-sync] {msg}")
+        full = len(_LOG_BUF) >= LOG_FLUSH_EVERY
+    if full:
+        flush_logs()
+
+
+def debug(msg: str) -> None:
+    if VERBOSE:
+        log(msg)
 
 
 def error(msg: str) -> None:
+    flush_logs()
     print(f"::error::{msg}", file=sys.stderr)
     sys.exit(1)
 
 
+atexit.register(flush_logs)
+
+
 def get_input(name: str, required: bool = True, default: str | None = None) -> str:
     env_name = f"INPUT_{name.upper()}"
     val = os.environ.get(env_name, "")
@@ -28,87 +94,558 @@ def get_input(name: str, required: bool = True, default: str | None = None) -> s
     return val
 
 
-def parse_bool(val: str) -> bool:
+def parse_bool(val: str, name: str) -> bool:
     normalized = val.strip().lower()
-    if normalized in ("true", "1", "yes", "y"):
+    if normalized in _TRUE_VALUES:
         return True
-    if normalized in ("false", "0", "no", "n", ""):
+    if normalized in _FALSE_VALUES:
         return False
-    error(f"Invalid boolean value for delete_remote: {val}")
+    error(f"Invalid boolean value for {name}: {val}")
     return False
 
 
+def parse_positive_int(val: str, name: str) -> int:
+    try:
+        parsed = int(val.strip())
+    except ValueError:
+        parsed = 0
+    if parsed < 1:
+        error(f"Invalid positive integer for {name}: {val}")
+    return parsed
+
+
 def normalize_prefix(prefix: str) -> str:
     return prefix if prefix.endswith("/") else prefix + "/"
 
 
 def split_patterns(raw: str) -> list[str]:
-    parts = []
-    for token in raw.split(","):
-        for line in token.splitlines():
-            cleaned = line.strip()
-            if cleaned:
-                parts.append(cleaned)
-    return parts
+    return [cleaned for line in raw.translate(_COMMA_TO_NEWLINE).splitlines() if (cleaned := line.strip())]
+
+
+def _split_magic(pat: str) -> tuple[str, list[str]]:
+    parts = pat.split("/")
+    for i, part in enumerate(parts):
+        if _MAGIC_CHECK.search(part):
+            prefix = "/".join(parts[:i])
+            if not prefix and i:
+                prefix = "/"
+            return prefix, [p for p in parts[i:] if p]
+    return pat, []
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_glob(part: str) -> Callable[[str], object]:
+    suffix = part[1:]
+    if part.startswith("*") and not _MAGIC_CHECK.search(suffix):
+        # "*.ext" is by far the most common segment; endswith skips the regex engine
+        return operator.methodcaller("endswith", suffix)
+    return re.compile(fnmatch.translate(part)).match
+
+
+def _scandir(dirpath: str) -> list[os.DirEntry[str]]:
+    try:
+        with os.scandir(dirpath or ".") as it:
+            return list(it)
+    except OSError:
+        return []
+
+
+def _iter_tree(dirpath: str) -> Iterator[tuple[str, os.DirEntry[str] | None]]:
+    for entry in _scandir(dirpath):
+        if entry.name.startswith("."):
+            continue
+        path = os.path.join(dirpath, entry.name)
+        yield path, entry
+        if entry.is_dir():
+            yield from _iter_tree(path)
+
+
+def _iter_glob(dirpath: str, parts: list[str]) -> Iterator[tuple[str, os.DirEntry[str] | None]]:
+    # Mirrors glob.glob(recursive=True): "*" and "**" skip dotfiles unless the segment starts with "."
+    # Matches carry their DirEntry when one is at hand so callers reuse its cached stat
+    if not parts:
+        yield dirpath, None
+        return
+    part, rest = parts[0], parts[1:]
+
+    if part == "**":
+        if not rest:
+            if dirpath:
+                yield dirpath, None
+            yield from _iter_tree(dirpath)
+            return
+        yield from _iter_glob(dirpath, rest)
+        for entry in _scandir(dirpath):
+            if not entry.name.startswith(".") and entry.is_dir():
+                yield from _iter_glob(os.path.join(dirpath, entry.name), parts)
+        return
+
+    if not _MAGIC_CHECK.search(part):
+        path = os.path.join(dirpath, part)
+        if os.path.isdir(path) if rest else os.path.lexists(path):
+            yield from _iter_glob(path, rest)
+        return
+
+    match = _compile_glob(part)
+    include_hidden = part.startswith(".")
+    for entry in _scandir(dirpath):
+        if entry.name.startswith(".") and not include_hidden:
+            continue
+        if not match(entry.name):
+            continue
+        # Non-matching directories are never descended into
+        if not rest:
+            yield os.path.join(dirpath, entry.name), entry
+        elif entry.is_dir():
+            yield from _iter_glob(os.path.join(dirpath, entry.name), rest)
+
+
+def _glob(pat: str) -> list[tuple[str, os.stat_result | None]]:
+    prefix, tail = _split_magic(pat)
+    if not tail:
+        return [(pat, None)] if os.path.lexists(pat) else []
+    matches: list[tuple[str, os.stat_result | None]] = []
+    for path, entry in _iter_glob(prefix, tail):
+        try:
+            st = entry.stat() if entry is not None else None
+        except OSError:
+            st = None
+        matches.append((path, st))
+    if pat.endswith("/"):
+        return [(path, st) for path, st in matches if os.path.isdir(path)]
+    return matches
+
+
+def _ancestors(path: str) -> Iterator[str]:
+    parent = os.path.dirname(path)
+    while parent != path:
+        yield parent
+        path, parent = parent, os.path.dirname(parent)
 
 
-def resolve_paths(patterns: list[str]) -> list[Path]:
-    paths: list[Path] = []
+def resolve_paths(patterns: list[str]) -> list[tuple[str, os.stat_result, bool]]:
+    # Keyed on the resolved path so overlapping globs collapse to one entry
+    resolved: dict[str, tuple[str, os.stat_result | None]] = {}
     for pat in patterns:
-        matches = [Path(p) for p in glob.glob(pat, recursive=True)]
+        matches = _glob(pat)
         if not matches:
             error(f"No files matched pattern: {pat}")
-        paths.extend(matches)
-    return paths
+        for match, st in matches:
+            resolved.setdefault(os.path.realpath(match), (match, st))
+
+    # Drop anything already covered by a matched ancestor directory (e.g. "dist/**" next to "dist")
+    accepted: set[str] = set()
+    for abs_path in sorted(resolved, key=len):
+        if not any(parent in accepted for parent in _ancestors(abs_path)):
+            accepted.add(abs_path)
+
+    if len(accepted) < len(resolved):
+        log(f"Dropped {len(resolved) - len(accepted)} matches already covered by another match")
+
+    entries: list[tuple[str, os.stat_result, bool]] = []
+    for abs_path, (match, st) in resolved.items():
+        if abs_path not in accepted:
+            continue
+        if st is None:
+            try:
+                st = os.stat(abs_path)
+            except OSError:
+                st = None
+        if st is None or not (stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode)):
+            error(f"Path is neither file nor directory: {match}")
+        entries.append((abs_path, st, stat.S_ISDIR(st.st_mode)))
+    return entries
 
 
-def stage_paths(paths: list[Path], staging_root: Path) -> None:
-    cwd = Path.cwd()
-    for src in paths:
-        abs_src = src.resolve()
-        try:
-            rel = abs_src.relative_to(cwd)
-        except ValueError:
-            error(f"Path must be within workspace: {abs_src}")
-        dest = staging_root / rel
+def _try_reflink(src_fd: int, dst_fd: int) -> bool:
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except OSError as exc:
+        if exc.errno in _REFLINK_UNSUPPORTED:
+            return False
+        raise
+    return True
 
-        if src.is_dir():
-            if dest.exists() and dest.is_file():
-                error(f"Collision while staging directory (file already staged here): {dest}")
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            log(f"Staging directory: {rel}")
-            shutil.copytree(abs_src, dest, dirs_exist_ok=True)
-        elif src.is_file():
-            if dest.exists():
-                if dest.is_file():
-                    log(f"Skipping already staged file from overlapping glob: {rel}")
+
+def _try_sendfile(src_fd: int, dst_fd: int, size: int) -> bool:
+    if not hasattr(os, "sendfile"):
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+        except OSError as exc:
+            if offset == 0 and exc.errno in _SENDFILE_UNSUPPORTED:
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    return True
+
+
+def _copy_fd(src_fd: int, dst_fd: int) -> None:
+    while True:
+        buf = os.read(src_fd, COPY_BUFSIZE)
+        if not buf:
+            break
+        view = memoryview(buf)
+        while view:
+            view = view[os.write(dst_fd, view):]
+
+
+def _fast_copy(src: str, dst: str, st: os.stat_result) -> None:
+    # reflink (CoW, metadata only) -> sendfile (in-kernel) -> large-buffer read/write
+    flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+    src_fd = os.open(src, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        if _HAS_FADVISE:
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        dst_fd = os.open(dst, flags, st.st_mode & 0o777)
+        try:
+            if not _try_reflink(src_fd, dst_fd) and not _try_sendfile(src_fd, dst_fd, st.st_size):
+                _copy_fd(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+        if _HAS_FADVISE:
+            # Source pages are not read again; the upload reads the staged copy
+            os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(src_fd)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _stage_file(src: str, dst: str, st: os.stat_result, link: bool) -> None:
+    if link:
+        try:
+            os.link(src, dst)
+            return
+        except OSError as exc:
+            if exc.errno not in _LINK_UNSUPPORTED:
+                raise
+    _fast_copy(src, dst, st)
+
+
+def _plan_tree(
+    src: str, dest: str, staging_root: str, planned: dict[str, bool]
+) -> Iterator[tuple[str, str, bool, os.stat_result | None]]:
+    # Explicit stack, str paths only; staging needs content + mtime, none of copytree's copystat
+    stack = [(src, dest)]
+    while stack:
+        src_dir, dest_dir = stack.pop()
+        with os.scandir(src_dir) as it:
+            for entry in it:
+                if entry.path == staging_root:
+                    # The staging dir lives inside the workspace; never stage it into itself
                     continue
+                target = os.path.join(dest_dir, entry.name)
+                if entry.is_dir():
+                    if planned.setdefault(target, True) is False:
+                        error(f"Collision while staging directory (file already staged here): {target}")
+                    yield entry.path, target, True, None
+                    stack.append((entry.path, target))
+                else:
+                    if planned.setdefault(target, False) is True:
+                        error(f"Collision while staging file (directory already staged here): {target}")
+                    yield entry.path, target, False, entry.stat()
+
+
+def _relative_to(abs_src: str, root: str) -> str:
+    rel = os.path.relpath(abs_src, root)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep) or os.path.isabs(rel):
+        error(f"Path must be within workspace: {abs_src}")
+    return rel
+
+
+def _plan_copies(
+    entries: list[tuple[str, os.stat_result, bool]], cwd: str, staging_root: str
+) -> Iterator[tuple[str, str, bool, os.stat_result | None]]:
+    # dest -> is_dir for everything planned so far; collisions are resolved here, before any I/O
+    planned: dict[str, bool] = {}
+    for abs_src, st, is_dir in entries:
+        rel = _relative_to(abs_src, cwd)
+        dest = staging_root if rel == os.curdir else os.path.join(staging_root, rel)
+
+        if is_dir:
+            if planned.setdefault(dest, True) is False:
+                error(f"Collision while staging directory (file already staged here): {dest}")
+            yield abs_src, dest, True, None
+            yield from _plan_tree(abs_src, dest, staging_root, planned)
+        else:
+            if planned.setdefault(dest, False) is True:
                 error(f"Collision while staging file (directory already staged here): {dest}")
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            log(f"Staging file: {rel}")
-            shutil.copy2(abs_src, dest)
+            yield abs_src, dest, False, st
+
+
+def stage_paths(entries: list[tuple[str, os.stat_result, bool]], staging_root: str) -> None:
+    cwd = os.getcwd()
+    # Hardlinks make staging metadata-only when the staging dir shares the source filesystem
+    link = os.stat(cwd).st_dev == os.stat(staging_root).st_dev
+
+    dirs: set[str] = set()
+    files: dict[str, tuple[str, os.stat_result]] = {}
+    for abs_src, dest, is_dir, st in _plan_copies(entries, cwd, staging_root):
+        if is_dir:
+            dirs.add(dest)
         else:
-            error(f"Path is neither file nor directory: {src}")
+            debug(f"Staging file: {abs_src}")
+            dirs.add(os.path.dirname(dest))
+            files.setdefault(dest, (abs_src, st))
+
+    for d in sorted(dirs):
+        os.makedirs(d, exist_ok=True)
+
+    workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_stage_file, src, dest, st, link) for dest, (src, st) in files.items()]
+        try:
+            for fut in as_completed(futures):
+                fut.result()
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            raise
+
+    method = "hardlinked" if link else "copied"
+    log(f"Staged {len(files)} files in {len(dirs)} directories from {len(entries)} paths ({method}, {workers} workers)")
 
 
 def run_cmd(cmd: list[str], cwd: Path | None = None, env: dict[str, str] | None = None) -> None:
     log(f"Running: {' '.join(cmd)}" + (f" (cwd={cwd})" if cwd else ""))
+    flush_logs()
     subprocess.run(cmd, check=True, cwd=str(cwd) if cwd else None, env=env)
 
 
-def configure_coscmd(secret_id: str, secret_key: str, bucket: str, region: str, accelerate: bool = False) -> None:
-    cmd = ["coscmd", "config", "-a", secret_id, "-s", secret_key, "-b", bucket]
+def make_cos_client(
+    secret_id: str, secret_key: str, region: str, pool_size: int, accelerate: bool = False
+) -> CosS3Client:
     if accelerate:
-        cmd += ["-e", "cos.accelerate.myqcloud.com"]
-        cmd += ["--retry", "5"]
-        cmd += ["--timeout", "60"]
-    else:
-        cmd += ["-r", region]
-        cmd += ["--retry", "1"] # 失败了赶紧fallback到全球加速
-        cmd += ["--timeout", "10"]
-        cmd += ["-m", "1"]
-    
-    run_cmd(cmd)
+        config = CosConfig(
+            Region=region,
+            SecretId=secret_id,
+            SecretKey=secret_key,
+            Endpoint=ACCELERATE_ENDPOINT,
+            Timeout=60,
+            PoolConnections=pool_size,
+            PoolMaxSize=pool_size,
+        )
+        return CosS3Client(config, retry=5)
+    # Transient errors are retried with backoff first; the accelerate fallback only sees what still fails.
+    # The first client builds the SDK's process-wide connection pool, so it has to size it for every client.
+    config = CosConfig(
+        Region=region,
+        SecretId=secret_id,
+        SecretKey=secret_key,
+        Timeout=30,
+        PoolConnections=pool_size,
+        PoolMaxSize=pool_size,
+    )
+    return CosS3Client(config, retry=3)
+
+
+def _is_transient(exc: CosServiceError) -> bool:
+    # The SDK already retries network errors and 5xx itself; 429 is the one 4xx it gives up on
+    return exc.get_status_code() == 429
+
+
+def retry(fn: Callable[[], T], max_retries: int = 3, base: float = 1.0, cap: float = 30.0, jitter: float = 0.5) -> T:
+    # CosS3Client(retry=...) covers network errors and 5xx without backoff; this layer only adds
+    # jittered backoff for throttling, which the SDK raises immediately, so the two never stack
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except CosServiceError as exc:
+            if attempt >= max_retries or not _is_transient(exc):
+                raise
+            delay = min(cap, base * 2**attempt) * (1 + random.random() * jitter)
+            attempt += 1
+            log(f"Transient COS error, retrying in {delay:.1f}s ({attempt}/{max_retries}): {exc}")
+            flush_logs()
+            time.sleep(delay)
+
+
+def _iter_files(root: str) -> Iterator[str]:
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                else:
+                    yield entry.path
+
+
+def plan_uploads(entries: list[tuple[str, os.stat_result, bool]], root: str, prefix: str) -> dict[str, str]:
+    # remote key -> local file; keys below a directory are sliced off its path rather than recomputed
+    uploads: dict[str, str] = {}
+    for abs_src, _, is_dir in entries:
+        rel = _relative_to(abs_src, root)
+        key = prefix if rel == os.curdir else prefix + rel.replace(os.sep, "/")
+        if is_dir:
+            base = len(abs_src) + 1
+            key_base = key if rel == os.curdir else key + "/"
+            for path in _iter_files(abs_src):
+                uploads[key_base + path[base:].replace(os.sep, "/")] = path
+        else:
+            uploads[key] = abs_src
+    return uploads
+
+
+def upload_files(client: CosS3Client, bucket: str, uploads: dict[str, str], part_threads: int) -> dict[str, str]:
+    # Returns the uploads that still failed after retries, so only those go to the fallback endpoint
+    failed: dict[str, str] = {}
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        futures = {
+            pool.submit(
+                retry,
+                functools.partial(
+                    client.upload_file,
+                    Bucket=bucket,
+                    Key=key,
+                    LocalFilePath=path,
+                    PartSize=PART_SIZE_MB,
+                    MAXThread=part_threads,
+                    EnableMD5=False,
+                ),
+            ): key
+            for key, path in uploads.items()
+        }
+        try:
+            for fut in as_completed(futures):
+                key = futures[fut]
+                try:
+                    fut.result()
+                    debug(f"Uploaded: {key}")
+                except (CosClientError, CosServiceError) as exc:
+                    log(f"Upload failed for {key}: {exc}")
+                    flush_logs()
+                    failed[key] = uploads[key]
+        except BaseException:
+            for fut in futures:
+                fut.cancel()
+            raise
+    log(f"Uploaded {len(uploads) - len(failed)}/{len(uploads)} files")
+    return failed
+
+
+def list_remote_objects(client: CosS3Client, bucket: str, prefix: str) -> dict[str, dict[str, str]]:
+    objects: dict[str, dict[str, str]] = {}
+    marker = ""
+    while True:
+        resp = retry(functools.partial(client.list_objects, Bucket=bucket, Prefix=prefix, Marker=marker, MaxKeys=1000))
+        for obj in resp.get("Contents", []):
+            objects[obj["Key"]] = obj
+        if resp.get("IsTruncated") != "true":
+            return objects
+        marker = resp["NextMarker"]
+
+
+def _file_md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        while chunk := f.read(COPY_BUFSIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _multipart_etag(path: str, size: int) -> str:
+    # Same part layout as CosS3Client.upload_file: PART_SIZE_MB parts, at most 10000 with the rest in the last one
+    part_size = PART_SIZE_MB * 1024 * 1024
+    parts = -(-size // part_size)
+    if parts > 10000:
+        parts = 10000
+        part_size = size // parts
+    digests = []
+    with open(path, "rb") as f:
+        for i in range(parts):
+            remaining = part_size if i < parts - 1 else size - part_size * (parts - 1)
+            digest = hashlib.md5()
+            while remaining and (chunk := f.read(min(COPY_BUFSIZE, remaining))):
+                digest.update(chunk)
+                remaining -= len(chunk)
+            digests.append(digest.digest())
+    return f"{hashlib.md5(b''.join(digests)).hexdigest()}-{parts}"
+
+
+def _is_unchanged(path: str, obj: dict[str, str] | None) -> bool:
+    if obj is None:
+        return False
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        # e.g. a dangling symlink; treat it as changed and let the upload report the error
+        return False
+    if int(obj.get("Size", -1)) != size:
+        return False
+    etag = obj.get("ETag", "").strip('"')
+    if "-" in etag:
+        # Multipart ETag: md5 of the concatenated part md5s, suffixed with the part count
+        return _multipart_etag(path, size) == etag
+    return _file_md5(path) == etag
+
+
+def filter_unchanged(uploads: dict[str, str], remote: dict[str, dict[str, str]]) -> dict[str, str]:
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        unchanged = list(pool.map(lambda item: _is_unchanged(item[1], remote.get(item[0])), uploads.items()))
+    pending = {key: path for (key, path), same in zip(uploads.items(), unchanged) if not same}
+    log(f"Skipping {len(uploads) - len(pending)} unchanged files already in the bucket")
+    return pending
+
+
+def delete_stale(client: CosS3Client, bucket: str, remote: dict[str, dict[str, str]], keep: dict[str, str]) -> None:
+    stale = [key for key in remote if key not in keep]
+    # Quiet mode still answers 200 and lists per-key failures under "Error"
+    failed: list[str] = []
+    for i in range(0, len(stale), DELETE_BATCH):
+        batch = stale[i:i + DELETE_BATCH]
+        delete = {"Object": [{"Key": key} for key in batch], "Quiet": "true"}
+        resp = retry(functools.partial(client.delete_objects, Bucket=bucket, Delete=delete))
+        failed.extend(f"{err.get('Key')} ({err.get('Code')})" for err in (resp or {}).get("Error", []))
+    log(f"Deleted {len(stale) - len(failed)} remote objects not in the upload set")
+    if failed:
+        error(f"Failed to delete {len(failed)} remote objects: {', '.join(failed)}")
+
+
+def sync_uploads(
+    uploads: dict[str, str],
+    bucket: str,
+    prefix: str,
+    delete_remote: bool,
+    part_threads: int,
+    secret_id: str,
+    secret_key: str,
+    region: str,
+) -> None:
+    # Every upload worker can have all of its part threads in flight at once
+    pool_size = UPLOAD_WORKERS * max(part_threads, ACCELERATE_PART_THREADS)
+    client = make_cos_client(secret_id, secret_key, region, pool_size)
+    # One paginated LIST instead of a HEAD per file to find what is already up to date
+    try:
+        remote: dict[str, dict[str, str]] | None = list_remote_objects(client, bucket, prefix)
+    except (CosClientError, CosServiceError) as exc:
+        log(f"Could not list remote objects, uploading everything: {exc}")
+        remote = None
+    pending = filter_unchanged(uploads, remote) if remote else uploads
+
+    failed = upload_files(client, bucket, pending, part_threads)
+    if failed:
+        log(f"{len(failed)} uploads failed with regional endpoint, retrying them with global accelerate endpoint")
+        flush_logs()
+        client = make_cos_client(secret_id, secret_key, region, pool_size, accelerate=True)
+        failed = upload_files(client, bucket, failed, ACCELERATE_PART_THREADS)
+        if failed:
+            error(f"Upload failed after retry with accelerate endpoint: {', '.join(sorted(failed))}")
+
+    if delete_remote:
+        try:
+            if remote is None:
+                remote = list_remote_objects(client, bucket, prefix)
+            delete_stale(client, bucket, remote, uploads)
+        except (CosClientError, CosServiceError) as exc:
+            error(f"Failed to delete stale remote objects: {exc}")
 
 
 def main() -> None:
@@ -118,10 +655,15 @@ def main() -> None:
     secret_key = get_input("secret_key")
     region = get_input("region")
     bucket = get_input("bucket")
-    prefix = normalize_prefix(get_input("prefix"))
+    # The SDK drops a leading "/" from object keys but not from list prefixes; strip it once for both
+    prefix = normalize_prefix(get_input("prefix")).lstrip("/")
     artifacts_raw = get_input("artifacts")
     flush_url = get_input("flush_url", required=False, default="")
-    delete_remote = parse_bool(get_input("delete_remote", required=False, default="false"))
+    delete_remote = parse_bool(get_input("delete_remote", required=False, default="false"), "delete_remote")
+    stage = parse_bool(get_input("stage", required=False, default="false"), "stage")
+    upload_concurrency = parse_positive_int(
+        get_input("upload_concurrency", required=False, default="4"), "upload_concurrency"
+    )
     working_dir_raw = get_input("working_directory", required=False, default="").strip()
 
     if working_dir_raw:
@@ -139,46 +681,49 @@ def main() -> None:
     if not patterns:
         error("No artifact patterns provided after normalization")
 
-    paths = resolve_paths(patterns)
-
-    log("Configuring coscmd (regional endpoint)")
-    configure_coscmd(secret_id, secret_key, bucket, region, accelerate=False)
-
-    with tempfile.TemporaryDirectory() as tmpdir:
-        staging_root = Path(tmpdir)
-        log(f"Staging uploads in: {staging_root}")
-        stage_paths(paths, staging_root)
-
-        flags = ["-rs", "--yes"]
-        if delete_remote:
-            flags.append("--delete")
-
-        try:
+    entries = resolve_paths(patterns)
+    flush_logs()
+
+    # Keep the staging dir on the workspace filesystem so files can be hardlinked
+    staging = (
+        tempfile.TemporaryDirectory(prefix=".cos-sync-", dir=workspace_root) if stage else contextlib.nullcontext()
+    )
+    with staging as tmpdir:
+        if tmpdir:
+            log(f"Staging uploads in: {tmpdir}")
+            stage_paths(entries, tmpdir)
+            flush_logs()
+            uploads = plan_uploads([(tmpdir, os.stat(tmpdir), True)], tmpdir, prefix)
+        else:
+            log("Uploading directly from the source tree")
+            uploads = plan_uploads(entries, os.getcwd(), prefix)
+        sync_uploads(
+            uploads,
+            bucket=bucket,
+            prefix=prefix,
+            delete_remote=delete_remote,
+            part_threads=upload_concurrency,
+            secret_id=secret_id,
+            secret_key=secret_key,
+            region=region,
+        )
+    flush_logs()
+
+    flush_urls = split_patterns(flush_url)
+    if flush_urls:
+        env = os.environ | {
+            "TENCENTCLOUD_SECRET_ID": secret_id,
+            "TENCENTCLOUD_SECRET_KEY": secret_key,
+            "TENCENTCLOUD_REGION": region,
+        }
+        # PurgePathCache accepts up to PURGE_BATCH paths per call; each tccli start costs about a second
+        for i in range(0, len(flush_urls), PURGE_BATCH):
+            batch = flush_urls[i:i + PURGE_BATCH]
+            log(f"Purge CDN cache: {', '.join(batch)}")
             run_cmd(
-                ["coscmd", "upload", *flags, ".", prefix],
-                cwd=staging_root,
+                ["tccli", "cdn", "PurgePathCache", "--cli-unfold-argument", "--Paths", *batch, "--FlushType", "flush"],
+                env=env,
             )
-        except CalledProcessError:
-            log("Upload failed with regional endpoint, retrying with global accelerate endpoint")
-            configure_coscmd(secret_id, secret_key, bucket, region, accelerate=True)
-            try:
-                run_cmd(
-                    ["coscmd", "upload", *flags, ".", prefix],
-                    cwd=staging_root,
-                )
-            except CalledProcessError as exc:
-                error(f"Upload failed after retry with accelerate endpoint: {exc}")
-
-    if flush_url:
-        log(f"Purge CDN cache: {flush_url}")
-        env = os.environ.copy()
-        env["TENCENTCLOUD_SECRET_ID"] = secret_id
-        env["TENCENTCLOUD_SECRET_KEY"] = secret_key
-        env["TENCENTCLOUD_REGION"] = region
-        run_cmd(
-            ["tccli", "cdn", "PurgePathCache", "--cli-unfold-argument", "--Paths", flush_url, "--FlushType", "flush"],
-            env=env,
-        )
     else:
         log("flush_url not provided; skipping CDN purge")
 